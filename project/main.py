@@ -50,13 +50,25 @@ def parse_args():
         default=0.5,
         help="Jaccard similarity threshold.",
     )
+    parser.add_argument(
+        "--auto_accept_bands",
+        type=int,
+        default=None,
+        help=(
+            "Accept candidate pairs that collide in at least this many LSH bands "
+            "without computing their exact Jaccard similarity (trades exactness for speed)."
+        ),
+    )
     parser.add_argument(
         "--output",
         type=str,
         default="result_test.txt",
         help="Output file path for similar user pairs.",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.auto_accept_bands is not None and args.auto_accept_bands < 1:
+        parser.error(f"--auto_accept_bands must be >= 1, got {args.auto_accept_bands}")
+    return args
 
 
 def main():
@@ -85,10 +97,11 @@ def main():
     print("Signatures shape:", signatures.shape)
 
     print("\nRunning LSH banding to get candidate pairs...")
-    candidates = lsh_candidate_pairs(
+    candidates, band_counts = lsh_candidate_pairs(
         signatures,
         rows_per_band=args.rows_per_band,
         max_bucket_size=500,
+        return_counts=True,
         verbose=True,
     )
 
@@ -101,7 +114,8 @@ def main():
         candidates,
         threshold=args.threshold,
         output_path=args.output,
-        close_each_write=True,
+        band_counts=band_counts,
+        auto_accept_bands=args.auto_accept_bands,
         verbose=True,
     )
 
@@ -44,13 +44,26 @@ def parse_args():
         default=0.5,
         help="Jaccard similarity threshold. Default: 0.5.",
     )
+    parser.add_argument(
+        "--auto_accept_bands",
+        type=int,
+        default=None,
+        help=(
+            "Accept candidate pairs that collide in at least this many LSH bands "
+            "without computing their exact Jaccard similarity (trades exactness for speed). "
+            "Default: disabled."
+        ),
+    )
     parser.add_argument(
         "--output",
         type=str,
         default="result.txt",
         help="Output file path for similar user pairs. Default: result.txt",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.auto_accept_bands is not None and args.auto_accept_bands < 1:
+        parser.error(f"--auto_accept_bands must be >= 1, got {args.auto_accept_bands}")
+    return args
 
 
 def main():
@@ -64,6 +77,10 @@ def main():
     print(f"num_hashes (h)  : {args.num_hashes}")
     print(f"rows_per_band r : {args.rows_per_band}")
     print(f"threshold       : {args.threshold}")
+    if args.auto_accept_bands is not None:
+        print(f"auto-accept     : pairs in >= {args.auto_accept_bands} bands")
+    else:
+        print("auto-accept     : disabled")
     print(f"output file     : {args.output}")
     print("==========================================\n")
 
@@ -88,10 +105,11 @@ def main():
 
     # 3) LSH banding → candidate pairs
     print("\nRunning LSH banding to get candidate pairs...")
-    candidates = lsh_candidate_pairs(
+    candidates, band_counts = lsh_candidate_pairs(
         signatures,
         rows_per_band=args.rows_per_band,
         max_bucket_size=500,
+        return_counts=True,
         verbose=True,
     )
 
@@ -104,7 +122,8 @@ def main():
         candidates,
         threshold=args.threshold,
         output_path=args.output,
-        close_each_write=True,   # safer if job gets killed
+        band_counts=band_counts,
+        auto_accept_bands=args.auto_accept_bands,
         verbose=True,
     )
 
@@ -3,13 +3,104 @@
 """
 Exact Jaccard similarity computation for user pairs using a CSR User x Movie matrix,
 and verification of candidate pairs produced by LSH.
+
+For verification every user's movie set is packed into a bit-vector of uint64 words,
+so that |A & B| is a popcount over a few hundred words per pair and
+|A | B| = |A| + |B| - |A & B| follows from the per-user popcounts.
 """
 
-from typing import Iterable, Set, Tuple
+import os
+from typing import Iterable, List, Optional, Tuple
 import numpy as np
 from scipy.sparse import csr_matrix
 
 
+# Number of set bits for every possible byte value
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# NumPy >= 2.0 ships np.bitwise_count, a ufunc compiled to the CPU's popcount instructions
+# (SIMD where available) that works directly on uint64 words.
+_HAS_BITWISE_COUNT = hasattr(np, "bitwise_count")
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    
+    # Number of set bits along the last axis of an array of uint64 words.
+    # For a 1D array this is a scalar, for a (n_pairs, n_words) array one count per row.
+
+    if _HAS_BITWISE_COUNT:
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+
+    # Older NumPy: byte-wise table lookup
+    return _POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def build_bitsets(R: csr_matrix, chunk_users: int = 10_000) -> np.ndarray:
+    
+    # Pack each user's movie set into a bit-vector: bit m of row u is set if user u rated movie m.
+    # Returns an array of shape (n_users, ceil(n_movies / 64)) with dtype uint64.
+
+    if not isinstance(R, csr_matrix):
+        raise TypeError("R must be a csr_matrix")
+
+    n_users, n_movies = R.shape
+    n_words = (n_movies + 63) // 64
+    bitsets = np.zeros((n_users, n_words), dtype=np.uint64)
+
+    indptr = R.indptr
+    indices = R.indices
+
+    # Scatter in chunks of users to keep the (row, word, bit) temporaries small
+    for start in range(0, n_users, chunk_users):
+        end = min(start + chunk_users, n_users)
+        cols = indices[indptr[start]:indptr[end]].astype(np.uint64)
+        rows = np.repeat(np.arange(end - start), np.diff(indptr[start:end + 1]))
+
+        words = (cols >> np.uint64(6)).astype(np.intp)
+        bits = np.uint64(1) << (cols & np.uint64(63))
+        np.bitwise_or.at(bitsets[start:end], (rows, words), bits)
+
+    return bitsets
+
+
+def jaccard_bitset_batch(
+    A: np.ndarray,
+    U1: np.ndarray,
+    U2: np.ndarray,
+    sizes: Optional[np.ndarray] = None,
+    batch_size: int = 10_000,
+    verbose: bool = False,
+) -> np.ndarray:
+    
+    # Compute Jaccard similarity for all pairs (U1[k], U2[k]) at once using the bit-vectors in A.
+    # Pairs are processed in batches of batch_size rows to bound the (batch, n_words) temporaries.
+    # sizes[u] = number of movies of user u (popcount of A[u]); computed here if not given.
+    # With the set sizes known, |A | B| = |A| + |B| - |A & B|, so each pair only needs
+    # one AND and one popcount per word.
+
+    if sizes is None:
+        sizes = _popcount(A)
+
+    n_pairs = U1.size
+    J = np.zeros(n_pairs, dtype=np.float64)
+
+    for start in range(0, n_pairs, batch_size):
+        end = min(start + batch_size, n_pairs)
+        u1 = U1[start:end]
+        u2 = U2[start:end]
+
+        intersection = _popcount(A[u1] & A[u2])  # A[u1] shape: (batch, n_words)
+        union_size = sizes[u1] + sizes[u2] - intersection
+
+        # Pairs with an empty union keep J = 0
+        np.divide(intersection, union_size, out=J[start:end], where=union_size > 0)
+
+        if verbose:
+            print(f"  Checked {end}/{n_pairs} candidate pairs")
+
+    return J
+
+
 def jaccard_similarity_csr(R: csr_matrix, u1: int, u2: int) -> float:
     
     # Compute Jaccard similarity between two users u1 and u2 using a CSR matrix.
@@ -36,24 +127,11 @@ def jaccard_similarity_csr(R: csr_matrix, u1: int, u2: int) -> float:
     cols1 = indices[start1:end1]
     cols2 = indices[start2:end2]
 
-    # Two-pointer intersection on sorted arrays
-    i = j = 0
-    intersection = 0
+    # Intersection in C; movies within a CSR row are unique, so assume_unique skips the dedup pass
+    intersection = np.intersect1d(cols1, cols2, assume_unique=True).size
     len1 = cols1.size
     len2 = cols2.size
 
-    while i < len1 and j < len2:
-        c1 = cols1[i]
-        c2 = cols2[j]
-        if c1 == c2:
-            intersection += 1
-            i += 1
-            j += 1
-        elif c1 < c2:
-            i += 1
-        else:
-            j += 1
-
     if intersection == 0:
         return 0.0
 
@@ -65,50 +143,134 @@ def jaccard_similarity_csr(R: csr_matrix, u1: int, u2: int) -> float:
     return intersection / union_size
 
 
+def _candidate_arrays(candidates: Iterable[Tuple[int, int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    
+    # Gather candidate pairs into two contiguous int32 arrays U1, U2 with U1[k] < U2[k],
+    # sorted by U1 so that consecutive pairs reuse the same bit-vector row.
+    # Also returns the sorting permutation, to reorder per-pair data given alongside the candidates.
+
+    pairs = np.array(
+        candidates if isinstance(candidates, np.ndarray) else list(candidates),
+        dtype=np.int32,
+    ).reshape(-1, 2)
+
+    U1 = np.minimum(pairs[:, 0], pairs[:, 1])
+    U2 = np.maximum(pairs[:, 0], pairs[:, 1])
+
+    order = np.lexsort((U2, U1))
+    return U1[order], U2[order], order
+
+
+def _flush_lines(f_out, lines: List[str]) -> None:
+    
+    # Write all buffered lines with a single write and push them to disk, so that the
+    # pairs found so far survive if the job gets killed.
+
+    if not lines:
+        return
+
+    f_out.write("".join(lines))
+    f_out.flush()
+    os.fsync(f_out.fileno())
+    lines.clear()
+
+
 def verify_candidates_and_write(
     R: csr_matrix,
     candidates: Iterable[Tuple[int, int]],
     threshold: float,
     output_path: str,
-    close_each_write: bool = True,
+    batch_size: int = 10_000,
+    flush_every: int = 10_000,
+    band_counts: Optional[np.ndarray] = None,
+    auto_accept_bands: Optional[int] = None,
+    method: str = "bitset",
     verbose: bool = True,
 ) -> int:
     
-    # Verify candidate pairs by exact Jaccard similarity and write those above a threshold to an output file
+    # Verify candidate pairs by exact Jaccard similarity and write those above a threshold to an output file.
+    # Accepted lines are buffered in memory and written every flush_every lines.
+    # If band_counts (number of LSH bands each candidate collided in, see lsh_candidate_pairs) and
+    # auto_accept_bands are given, pairs with band_counts >= auto_accept_bands are written without
+    # computing their exact Jaccard similarity.
+    # method="bitset" (default) uses the batched bit-vector kernel, method="csr" checks pairs one by
+    # one with jaccard_similarity_csr (no bit-vectors needed, useful as a reference and fallback).
 
-    num_written = 0
+    if method not in ("bitset", "csr"):
+        raise ValueError(f"method must be 'bitset' or 'csr', got {method!r}")
 
-    # To optionally do one open/close outside (when close_each_write=False)
-    f = None
-    if not close_each_write:
-        f = open(output_path, "a", buffering=1)  # line-buffered
+    U1, U2, order = _candidate_arrays(candidates)
+    n_pairs = U1.size
 
-    for idx, (u1, u2) in enumerate(candidates):
-        jacc = jaccard_similarity_csr(R, u1, u2)
-        if jacc >= threshold:
-            # Convert back to 1-based user IDs for output
-            uid1 = u1 + 1
-            uid2 = u2 + 1
-            if uid1 > uid2:
-                uid1, uid2 = uid2, uid1
+    if auto_accept_bands is not None:
+        if auto_accept_bands < 1:
+            raise ValueError(
+                f"auto_accept_bands must be >= 1 (every candidate shares at least one band), "
+                f"got {auto_accept_bands}"
+            )
+        if band_counts is None:
+            raise ValueError("auto_accept_bands requires band_counts")
+        band_counts = np.asarray(band_counts)
+        if band_counts.shape != (n_pairs,):
+            raise ValueError(
+                f"band_counts must have one entry per candidate pair, got shape {band_counts.shape}"
+            )
+        auto_accepted = band_counts[order] >= auto_accept_bands
+    else:
+        auto_accepted = np.zeros(n_pairs, dtype=bool)
+
+    num_auto_accepted = int(np.count_nonzero(auto_accepted))
 
-            line = f"{uid1},{uid2}\n"
+    if method == "bitset":
+        # Movie sets of all users as bit-vectors, built once for the whole verification
+        A = build_bitsets(R)
+        # Number of distinct movies per user, from the bit-vectors so duplicate CSR entries don't count twice
+        sizes = _popcount(A)
 
-            if close_each_write:
-                with open(output_path, "a") as f_out:
-                    f_out.write(line)
+    num_written = 0
+    pending: List[str] = []
+
+    with open(output_path, "w", buffering=1 << 20) as f_out:
+        for start in range(0, n_pairs, batch_size):
+            end = min(start + batch_size, n_pairs)
+            u1 = U1[start:end]
+            u2 = U2[start:end]
+
+            # Pairs found in enough bands are accepted as they are, the rest get exact Jaccard
+            accepted = auto_accepted[start:end].copy()
+            to_check = ~accepted
+            if method == "bitset":
+                J = jaccard_bitset_batch(A, u1[to_check], u2[to_check], sizes=sizes, batch_size=batch_size)
             else:
-                f.write(line)
+                J = np.array(
+                    [jaccard_similarity_csr(R, a, b) for a, b in zip(u1[to_check].tolist(), u2[to_check].tolist())],
+                    dtype=np.float64,
+                )
+            accepted[to_check] = J >= threshold
 
-            num_written += 1
+            # Convert back to 1-based user IDs for output
+            uid1 = (u1[accepted] + 1).tolist()
+            uid2 = (u2[accepted] + 1).tolist()
+            pending.extend(f"{a},{b}\n" for a, b in zip(uid1, uid2))
+            num_written += len(uid1)
+
+            if len(pending) >= flush_every:
+                _flush_lines(f_out, pending)
 
-        if verbose and (idx + 1) % 10_000 == 0:
-            print(f"  Checked {idx + 1} candidate pairs, written {num_written} so far")
+            if verbose:
+                print(f"  Checked {end}/{n_pairs} candidate pairs, written {num_written} so far")
 
-    if not close_each_write and f is not None:
-        f.close()
+        _flush_lines(f_out, pending)
 
     if verbose:
-        print(f"Total candidate pairs written (J >= {threshold}): {num_written}")
+        if auto_accept_bands is not None:
+            print(f"Verified candidate pairs written (J >= {threshold}): {num_written - num_auto_accepted}")
+            print(
+                f"Candidate pairs written without verification "
+                f"(>= {auto_accept_bands} bands): {num_auto_accepted}"
+            )
+            print(f"Total candidate pairs written: {num_written}")
+        else:
+            print(f"Total candidate pairs written (J >= {threshold}): {num_written}")
 
-    return num_written
\ No newline at end of file
+    return num_written
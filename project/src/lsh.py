@@ -9,27 +9,136 @@ This module takes a minhash signature matrix and:
 - Produces candidate user pairs that share at least one identical band.
 """
 
-from typing import Dict, List, Set, Tuple
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Union
 import numpy as np
 
 
-def _band_key_to_bytes(band: np.ndarray) -> bytes:
+# Odd 64-bit multiplier used to mix band rows into one key when they do not fit in 64 bits
+_KEY_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _band_keys(band: np.ndarray, specialized: bool = True) -> np.ndarray:
+    
+    # Convert a 2D band of the signature matrix (n_users, rows_per_band) into a 1D array of
+    # keys, one per user, such that users with identical band rows get identical keys.
+    #
+    # Specialized layout (integer signatures): each key is a native uint64, which np.unique
+    # sorts several times faster than raw byte strings.
+    # - If rows_per_band * itemsize <= 8 bytes (e.g. 4 uint16 rows) the rows are packed exactly.
+    # - Otherwise (e.g. the default 5 uint16 rows = 10 bytes) the rows are mixed with a
+    #   multiply-add hash. Distinct bands then collide with probability ~2^-64, which at worst
+    #   adds a candidate pair that exact verification rejects.
+    # Generic layout: each row's raw bytes viewed as a single np.void element.
+
+    n_rows = band.shape[1]
+    itemsize = band.dtype.itemsize
+
+    if specialized and band.dtype.kind in "ui" and itemsize <= 4:
+        # Reinterpret as unsigned so that every value maps to [0, 2^(8 * itemsize))
+        cols = band.view(np.dtype(f"u{itemsize}"))
+        keys = cols[:, 0].astype(np.uint64)
+
+        if n_rows * itemsize <= 8:
+            shift = np.uint64(8 * itemsize)
+            for j in range(1, n_rows):
+                keys <<= shift
+                keys |= cols[:, j]
+        else:
+            for j in range(1, n_rows):
+                keys *= _KEY_MULTIPLIER
+                keys += cols[:, j]
+
+        return keys
+
+    # Ensure contiguous rows (keeping the signature dtype, e.g. uint16), then view each row as raw bytes
+    band = np.ascontiguousarray(band)
+    key_dtype = np.dtype((np.void, itemsize * n_rows))
+    return band.view(key_dtype).ravel()
+
+
+def _band_buckets(
+    band: np.ndarray,
+    max_bucket_size: int,
+    specialized: bool = True,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    
+    # Bucket the users of one band (n_users, rows_per_band).
+    # Returns (users_sorted, bucket_starts, bucket_sizes, num_large_buckets) where the users of
+    # the g-th kept bucket are users_sorted[bucket_starts[g]:bucket_starts[g] + bucket_sizes[g]].
+    # Only buckets that produce pairs (2 <= size <= max_bucket_size) are kept.
+    # The heavy work (unique, argsort) runs in NumPy and releases the GIL,
+    # so several bands can be processed by threads at once.
+
+    keys = _band_keys(band, specialized=specialized)  # shape: (n_users,)
+
+    # bucket_ids[u] = index of the bucket (distinct band key) of user u
+    _, bucket_ids = np.unique(keys, return_inverse=True)
+    bucket_ids = bucket_ids.ravel()
+
+    users_sorted = np.argsort(bucket_ids, kind="stable")
+    bucket_sizes = np.bincount(bucket_ids)
+    bucket_starts = np.concatenate(([0], np.cumsum(bucket_sizes)[:-1]))
+
+    # Skip very large buckets to avoid O(k^2) explosion
+    num_large_buckets = int(np.count_nonzero(bucket_sizes > max_bucket_size))
+
+    valid = (bucket_sizes >= 2) & (bucket_sizes <= max_bucket_size)
+    return users_sorted, bucket_starts[valid], bucket_sizes[valid], num_large_buckets
+
+
+def _num_bucket_pairs(bucket_sizes: np.ndarray) -> int:
     
-    #Convert a 1D array of integers (a band of the signature) into a bytes object suitable for use as a dictionary key.
+    # Number of pairs generated by buckets of the given sizes: sum of k * (k - 1) / 2.
+
+    k = bucket_sizes.astype(np.int64)
+    return int((k * (k - 1) // 2).sum())
+
+
+def _fill_bucket_pairs(
+    users_sorted: np.ndarray,
+    bucket_starts: np.ndarray,
+    bucket_sizes: np.ndarray,
+    out: np.ndarray,
+) -> None:
     
-    # Ensure contiguous int32, then view as raw bytes
-    band = np.asarray(band, dtype=np.int32)
-    return band.tobytes()
+    # Write all pairs of the given buckets into out, packed as (u1 << 32) | u2 with u1 < u2.
+    # out must have exactly _num_bucket_pairs(bucket_sizes) entries.
+
+    pos = 0
+
+    # All buckets of the same size k are expanded at once; k is limited by max_bucket_size
+    for k in np.unique(bucket_sizes):
+        starts = bucket_starts[bucket_sizes == k]
+
+        # users shape: (num_buckets_of_size_k, k), ascending within each row (stable argsort)
+        users = users_sorted[starts[:, None] + np.arange(k)].astype(np.uint64)
+
+        # All pairs (i, j) with i < j inside a bucket, hence users[:, i] < users[:, j]
+        i, j = np.triu_indices(k, 1)
+        block = out[pos:pos + starts.size * i.size].reshape(starts.size, i.size)
+        np.left_shift(users[:, i], np.uint64(32), out=block)
+        block |= users[:, j]
+
+        pos += block.size
 
 
 def lsh_candidate_pairs(
     signatures: np.ndarray,
     rows_per_band: int,
     max_bucket_size: int = 100,
+    n_jobs: Optional[int] = None,
+    return_counts: bool = False,
+    specialized: bool = True,
     verbose: bool = True,
-) -> Set[Tuple[int, int]]:
+) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
     
     # Perform LSH banding on a minhash signature matrix and return candidate pairs.
+    # The result has shape (n_pairs, 2) with one row (u1, u2), u1 < u2, per distinct pair.
+    # With return_counts=True, also return the number of bands in which each pair collided.
+    # Bands are processed by a pool of n_jobs threads (None: one per CPU core).
+    # specialized=True uses native uint64 band keys for integer signatures (see _band_keys).
     
     if signatures.ndim != 2:
         raise ValueError("signatures must be a 2D array")
@@ -45,67 +154,83 @@ def lsh_candidate_pairs(
             f"rows_per_band={rows_per_band} is too large for num_hashes={num_hashes}"
         )
 
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs <= 0:
+        raise ValueError("n_jobs must be positive")
+
     if verbose:
         print(f"LSH banding with:")
         print(f"  n_users      = {n_users}")
         print(f"  num_hashes   = {num_hashes}")
         print(f"  rows_per_band= {rows_per_band}")
         print(f"  num_bands    = {num_bands}")
+        print(f"  n_jobs       = {n_jobs}")
         leftover = num_hashes - num_bands * rows_per_band
         if leftover > 0:
             print(f"  Warning: ignoring leftover {leftover} hash components at the end.")
 
-    # Dictionary: (band_index, band_bytes) -> list of user indices
-    buckets: Dict[Tuple[int, bytes], List[int]] = {}
-
-    # Build buckets
-    for band_idx in range(num_bands):
-        start = band_idx * rows_per_band
-        end = start + rows_per_band
+    # Bands are independent: each one reads its own column slice of the signatures.
+    bands = [
+        signatures[:, band_idx * rows_per_band:(band_idx + 1) * rows_per_band]
+        for band_idx in range(num_bands)
+    ]
 
-        if verbose:
-            print(f"Processing band {band_idx + 1}/{num_bands} (columns {start}:{end})")
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        # Pass 1: bucket every band and count the pairs it will produce.
+        # The buckets of a band are a few arrays of length <= n_users, much smaller than its pairs.
+        band_buckets = list(executor.map(
+            lambda band: _band_buckets(band, max_bucket_size, specialized=specialized),
+            bands,
+        ))
 
-        for u in range(n_users):
-            band = signatures[u, start:end]  # shape: (rows_per_band,)
-            key_bytes = _band_key_to_bytes(band)
-            bucket_key = (band_idx, key_bytes)
+        num_large_buckets = sum(buckets[3] for buckets in band_buckets)
+        band_num_pairs = [_num_bucket_pairs(buckets[2]) for buckets in band_buckets]
 
-            if bucket_key not in buckets:
-                buckets[bucket_key] = []
-            buckets[bucket_key].append(u)
+        # Candidate pairs of every band, packed as (u1 << 32) | u2 with u1 < u2.
+        # Band b owns packed[offsets[b]:offsets[b + 1]], so the array is allocated once at its exact size.
+        offsets = np.concatenate(([0], np.cumsum(band_num_pairs, dtype=np.int64)))
+        packed = np.empty(offsets[-1], dtype=np.uint64)
 
-    if verbose:
-        print("Finished filling buckets. Now generating candidate pairs...")
-
-    # Generate candidate pairs from buckets
-    candidates: Set[Tuple[int, int]] = set()
-    num_large_buckets = 0
-
-    for (band_idx, band_key), users in buckets.items():
-        k = len(users)
-        if k < 2:
-            continue  # no pairs here
-
-        if k > max_bucket_size:
-            # Skip very large buckets to avoid O(k^2) explosion
-            num_large_buckets += 1
-            continue
-
-        # Generate all pairs (u1, u2) with u1 < u2
-        # Simple double loop; k is limited by max_bucket_size
-        for i in range(k):
-            u1 = users[i]
-            for j in range(i + 1, k):
-                u2 = users[j]
-                if u1 < u2:
-                    pair = (u1, u2)
-                else:
-                    pair = (u2, u1)
-                candidates.add(pair)
+        if verbose:
+            for band_idx in range(num_bands):
+                start = band_idx * rows_per_band
+                end = start + rows_per_band
+                print(
+                    f"Band {band_idx + 1}/{num_bands} (columns {start}:{end}): "
+                    f"{band_num_pairs[band_idx]} pairs"
+                )
+            print(f"Total pairs over all bands (before deduplication): {packed.size}")
+
+        # Pass 2: every band writes its pairs into its own slice
+        list(executor.map(
+            lambda band_idx: _fill_bucket_pairs(
+                *band_buckets[band_idx][:3],
+                out=packed[offsets[band_idx]:offsets[band_idx + 1]],
+            ),
+            range(num_bands),
+        ))
+
+    del band_buckets
+
+    # The same pair can share several bands (at most once per band): sort in place and keep the
+    # first entry of each run of equal values, the run length is the number of bands it collided in
+    packed.sort()
+    is_first = np.ones(packed.size, dtype=bool)
+    np.not_equal(packed[1:], packed[:-1], out=is_first[1:])
+    first_idx = np.flatnonzero(is_first)
+
+    band_counts = np.diff(np.append(first_idx, packed.size))
+    packed = packed[first_idx]
+
+    candidates = np.empty((packed.size, 2), dtype=np.int32)
+    candidates[:, 0] = packed >> np.uint64(32)
+    candidates[:, 1] = packed & np.uint64(0xFFFFFFFF)
 
     if verbose:
         print(f"Number of candidate pairs: {len(candidates)}")
         print(f"Number of skipped large buckets (size > {max_bucket_size}): {num_large_buckets}")
 
+    if return_counts:
+        return candidates, band_counts.astype(np.int32)
     return candidates
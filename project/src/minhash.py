@@ -4,7 +4,7 @@
 Minhash signature computation for the Netflix LSH assignment.
 
 This module provides:
-- A function to generate random hash functions of the form h(m) = (a*m + b) % p.
+- A function to generate random hash functions of the form h(m) = (a*m + b) % p, p = 2^31 - 1.
 - A function to compute minhash signatures for all users in a User x Movie CSR matrix.
 """
 
@@ -13,6 +13,22 @@ import numpy as np
 from scipy.sparse import csr_matrix
 
 
+# 2^31 - 1, the modulus of all hash functions
+MERSENNE_PRIME_31 = (1 << 31) - 1
+
+
+def _mod_mersenne31(x: np.ndarray, scratch: np.ndarray) -> None:
+    
+    # In-place x %= 2^31 - 1 for int64 values 0 <= x < (2^31 - 1)^2, without a division:
+    # x = hi * 2^31 + lo  =>  x = hi + lo (mod p), and hi + lo < 2p needs at most one subtraction.
+
+    p = MERSENNE_PRIME_31
+    np.right_shift(x, 31, out=scratch)
+    np.bitwise_and(x, p, out=x)
+    x += scratch
+    np.subtract(x, p, out=x, where=x >= p)
+
+
 def generate_hash_functions(
     num_hashes: int,
     max_value: int,
@@ -21,8 +37,9 @@ def generate_hash_functions(
     # Generate random hash functions of the form h(x) = (a * x + b) % p.
     
     # Choose a fixed large prime > max_value. We can keep this simple.
-    # 2_000_003 is a prime larger than typical n_movies (~17k).
-    p = 2_000_003
+    # The Mersenne prime 2^31 - 1 is far larger than typical n_movies (~17k) and lets
+    # x % p be computed with a shift and an add (see _mod_mersenne31).
+    p = MERSENNE_PRIME_31
 
     a = rng.integers(1, p, size=num_hashes, dtype=np.int64)
     b = rng.integers(0, p, size=num_hashes, dtype=np.int64)
@@ -30,10 +47,71 @@ def generate_hash_functions(
     return a, b, p
 
 
+def _minhash_kernel(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    a: np.ndarray,
+    b: np.ndarray,
+    p: int,
+    n_movies: int,
+    out: np.ndarray,
+    verbose: bool = False,
+) -> None:
+    # Fill out[i, u] = min_{m in movies rated by u} h_i(m) directly from the CSR arrays.
+    # out has shape (num_hashes, n_users) so that each hash writes one contiguous row.
+
+    # The modulus is computed by _mod_mersenne31, which only supports p = 2^31 - 1
+    if p != MERSENNE_PRIME_31:
+        raise ValueError(f"p must be MERSENNE_PRIME_31 = {MERSENNE_PRIME_31}, got {p}")
+
+    num_hashes, n_users = out.shape
+    nnz = indices.size
+
+    # movie_ids: 0, 1, ..., n_movies-1
+    movie_ids = np.arange(n_movies, dtype=np.int64)
+    # Hash values of all movies for the current hash function only: h_row[m] = h_i(m).
+    # The full (num_hashes, n_movies) table is never materialized.
+    # a * m + b needs int64, but reduced values are < p = 2^31 - 1 and are stored as int32
+    # (h_row32, v) so that the gather and the reduction over nnz move half the bytes.
+    h_row = np.empty(n_movies, dtype=np.int64)
+    h_scratch = np.empty(n_movies, dtype=np.int64)
+    h_row32 = np.empty(n_movies, dtype=np.int32)
+
+    # Users without any rated movie have no segment in R.indices.
+    # This case should not happen in this dataset (each user rated >= 300 movies),
+    # but we handle it defensively.
+    empty = np.diff(indptr) == 0
+    empty_value = p  # larger than any hash value, which are all < p
+
+    # Scratch buffer reused by every hash: v[k] = h_i(indices[k]).
+    # The extra trailing slot holds empty_value so that reduceat can be fed the full
+    # indptr[:-1] (trailing empty users point at offset nnz) without changing any min.
+    v = np.empty(nnz + 1, dtype=np.int32)
+    v[nnz] = empty_value
+    starts = indptr[:-1]
+
+    # Hash functions are the outer loop: for hash i we gather h_i(m) for every
+    # (user, movie) entry of R and take the min per user segment in a single C loop.
+    for i in range(num_hashes):
+        np.multiply(a[i], movie_ids, out=h_row)
+        h_row += b[i]
+        _mod_mersenne31(h_row, h_scratch)
+        h_row32[:] = h_row
+
+        np.take(h_row32, indices, out=v[:nnz])
+        np.minimum.reduceat(v, starts, out=out[i])
+        # reduceat returns v[start] for zero-length segments, overwrite those.
+        out[i, empty] = empty_value
+
+        if verbose and (i + 1) % 10 == 0:
+            print(f"  Processed {i + 1}/{num_hashes} hash functions for minhash signatures")
+
+
 def compute_minhash_signatures(
     R: csr_matrix,
     num_hashes: int,
     seed: int,
+    quantize: bool = True,
     verbose: bool = True,
 ) -> np.ndarray:
     """
@@ -42,6 +120,8 @@ def compute_minhash_signatures(
     For each user u and each hash function h_i, we compute:
         signature[u, i] = min_{m in movies rated by u} h_i(m)
 
+    With quantize=True the result is passed through quantize_signatures (uint16),
+    which is all LSH banding needs since it only compares entries for equality.
     """
     
     if not isinstance(R, csr_matrix):
@@ -52,39 +132,27 @@ def compute_minhash_signatures(
     rng = np.random.default_rng(seed)
     a, b, p = generate_hash_functions(num_hashes, n_movies, rng)
 
-    # Precompute hash values for all movies and all hash functions.
-    # movie_ids: 0, 1, ..., n_movies-1
-    movie_ids = np.arange(n_movies, dtype=np.int64)
-    # h_vals shape: (num_hashes, n_movies)
-    # h_vals[i, m] = h_i(m)
-    h_vals = (a[:, None] * movie_ids[None, :] + b[:, None]) % p
-
-    # Prepare output array: each row is a user, each column is a hash function.
-    # We'll use int32 to save some memory (values are < p ~ 2e6).
-    signatures = np.empty((n_users, num_hashes), dtype=np.int32)
-
-    # For convenience, keep references to CSR internals
-    indptr = R.indptr
-    indices = R.indices
-
-    for u in range(n_users):
-        start = indptr[u]
-        end = indptr[u + 1]
-        user_movies = indices[start:end]  # 0-based movie indices rated by user u
-
-        if user_movies.size == 0:
-            # This case should not happen in this dataset (each user rated >= 300 movies),
-            # but we handle it defensively.
-            signatures[u, :] = p + 1  # some large value
-        else:
-            # Take the precomputed hash values for these movies and compute the min.
-            # user_hashes shape: (num_hashes, k_u)
-            user_hashes = h_vals[:, user_movies]
-            # min over movies (axis=1) -> shape (num_hashes,)
-            minhash_values = user_hashes.min(axis=1)
-            signatures[u, :] = minhash_values.astype(np.int32)
-
-        if verbose and (u + 1) % 10_000 == 0:
-            print(f"  Processed {u + 1}/{n_users} users for minhash signatures")
+    # Prepare output array: one row per hash function while filling, transposed at the end
+    # so that each row is a user, each column is a hash function.
+    # We'll use int32 to save some memory (values are < p = 2^31 - 1).
+    signatures_t = np.empty((num_hashes, n_users), dtype=np.int32)
+
+    if n_users > 0:
+        _minhash_kernel(R.indptr, R.indices, a, b, p, n_movies, signatures_t, verbose=verbose)
 
+    signatures = np.ascontiguousarray(signatures_t.T)
+
+    if quantize:
+        return quantize_signatures(signatures)
     return signatures
+
+
+def quantize_signatures(signatures: np.ndarray) -> np.ndarray:
+    
+    # Reduce each minhash value to 16 bits with a multiplicative (Fibonacci) hash:
+    # h' = (h * 0x9E3779B97F4A7C15 mod 2^64) >> 48.
+    # Equal values stay equal, different values collide with probability ~2^-16 per entry,
+    # and the signature matrix takes half the memory of int32.
+
+    mixed = signatures.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return (mixed >> np.uint64(48)).astype(np.uint16)